@@ -3,7 +3,9 @@ import configparser
 import contextlib
 from datetime import datetime, timezone
 import difflib
+import functools
 import itertools
+import json
 import os
 import shlex
 import shutil
@@ -12,23 +14,47 @@ import tarfile
 import tempfile
 import time
 import subprocess
+import urllib.request
 
 import jinja2
-import requests
-import tqdm
 
 from . import Metadata, licensing
-from .metadata import normalize_deps
+from .metadata import normalize_deps, read_manifest
 
 DEFAULT_EDITOR = "vi"
 XDG_CACHE_HOME = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
 CACHEDIR = os.path.join(XDG_CACHE_HOME, "rust2rpm")
+JINJA_CACHEDIR = os.path.join(CACHEDIR, "jinja-bc")
 API_URL = "https://crates.io/api/v1/"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Seconds to wait on a stalled connection to crates.io
+TIMEOUT = 10
+# Bump whenever Metadata.from_json() starts reading different manifest fields
+MANIFEST_CACHE_FORMAT = 1
+# Python 3.12 (and security backports) can also reject unsafe links on extraction
+HAS_TAR_FILTER = hasattr(tarfile, "data_filter")
+USER_AGENT = "rust2rpm (https://pagure.io/fedora-rust/rust2rpm)"
+
+# The on-disk template cache is only a speed-up, it must never fail a run
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError:
+            pass
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
 JINJA_ENV = jinja2.Environment(loader=jinja2.ChoiceLoader([
                                    jinja2.FileSystemLoader(["/"]),
                                    jinja2.PackageLoader("rust2rpm", "templates"),
                                ]),
                                extensions=["jinja2.ext.do"],
+                               bytecode_cache=BytecodeCache(JINJA_CACHEDIR),
                                trim_blocks=True,
                                lstrip_blocks=True)
 
@@ -71,10 +97,20 @@ def detect_editor():
     return editor
 
 def detect_packager():
+    # rpmdev-packager honours $RPM_PACKAGER first, no need to spawn it
+    packager = os.getenv("RPM_PACKAGER")
+    if packager:
+        return packager
+
     rpmdev_packager = shutil.which("rpmdev-packager")
     if rpmdev_packager is not None:
         return subprocess.check_output(rpmdev_packager, universal_newlines=True).strip()
 
+    name = os.getenv("GIT_AUTHOR_NAME")
+    email = os.getenv("GIT_AUTHOR_EMAIL")
+    if name and email:
+        return f"{name} <{email}>"
+
     git = shutil.which("git")
     if git is not None:
         name = subprocess.check_output([git, "config", "user.name"], universal_newlines=True).strip()
@@ -105,59 +141,55 @@ def local_crate(crate, version):
     cratename, version = os.path.basename(crate)[:-6].rsplit("-", 1)
     return crate, cratename, version
 
+def urlopen(url):
+    return urllib.request.urlopen(urllib.request.Request(url, headers={"User-Agent": USER_AGENT}),
+                                  timeout=TIMEOUT)
+
 def download(crate, version):
     if version is None:
         # Now we need to get latest version
-        url = requests.compat.urljoin(API_URL, f"crates/{crate}/versions")
-        req = requests.get(url)
-        req.raise_for_status()
-        versions = req.json()["versions"]
+        url = f"{API_URL}crates/{crate}/versions"
+        with urlopen(url) as req:
+            versions = json.load(req)["versions"]
         version = next(version["num"] for version in versions if not version["yanked"])
 
     os.makedirs(CACHEDIR, exist_ok=True)
     cratef_base = f"{crate}-{version}.crate"
     cratef = os.path.join(CACHEDIR, cratef_base)
     if not os.path.isfile(cratef):
-        url = requests.compat.urljoin(API_URL, f"crates/{crate}/{version}/download#")
-        req = requests.get(url, stream=True)
-        req.raise_for_status()
-        total = int(req.headers["Content-Length"])
-        with remove_on_error(cratef), \
-             open(cratef, "wb") as f:
-            for chunk in tqdm.tqdm(req.iter_content(), f"Downloading {cratef_base}".format(cratef_base),
-                                   total=total, unit="B", unit_scale=True):
-                f.write(chunk)
+        # Only needed for the progress bar, don't pay for it on cached crates
+        import tqdm
+
+        url = f"{API_URL}crates/{crate}/{version}/download"
+        with urlopen(url) as req:
+            total = int(req.headers["Content-Length"])
+            # Download next to the final name, so an interrupted run never
+            # leaves a truncated crate behind in the cache
+            cratef_part = f"{cratef}.part"
+            with remove_on_error(cratef_part), \
+                 open(cratef_part, "wb") as f, \
+                 tqdm.tqdm(desc=f"Downloading {cratef_base}", total=total,
+                           unit="B", unit_scale=True, unit_divisor=1024) as progress:
+                for chunk in iter(lambda: req.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    progress.update(len(chunk))
+            os.replace(cratef_part, cratef)
     return cratef, crate, version
 
 @contextlib.contextmanager
 def toml_from_crate(cratef, crate, version):
+    toml_relpath = f"{crate}-{version}/Cargo.toml"
     with tempfile.TemporaryDirectory() as tmpdir:
-        target_dir = f"{tmpdir}/"
-        with tarfile.open(cratef, "r") as archive:
-            for n in archive.getnames():
-                if not os.path.abspath(os.path.join(target_dir, n)).startswith(target_dir):
+        target_dir = os.path.realpath(tmpdir) + os.sep
+        extract_kwargs = {"filter": "data"} if HAS_TAR_FILTER else {}
+        # Stream through the archive once, extracting members as they are read
+        with tarfile.open(cratef, "r|*") as archive:
+            for member in archive:
+                # The data filter would silently strip a leading "/" instead
+                if not os.path.normpath(os.path.join(target_dir, member.name)).startswith(target_dir):
                     raise Exception("Unsafe filenames!")
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(archive, target_dir)
-        toml_relpath = f"{crate}-{version}/Cargo.toml"
+                # Directory permissions would be applied before their contents exist
+                archive.extract(member, target_dir, set_attrs=not member.isdir(), **extract_kwargs)
         toml = f"{tmpdir}/{toml_relpath}"
         if not os.path.isfile(toml):
             raise IOError("crate does not contain Cargo.toml file")
@@ -170,7 +202,8 @@ def make_patch(toml, enabled=True, tmpfile=False):
     editor = detect_editor()
 
     mtime_before = file_mtime(toml)
-    toml_before = open(toml).readlines()
+    with open(toml) as fobj:
+        toml_before = fobj.readlines()
 
     # When we are editing a git checkout, we should not modify the real file.
     # When we are editing an unpacked crate, we are free to edit anything.
@@ -185,13 +218,43 @@ def make_patch(toml, enabled=True, tmpfile=False):
         fname = toml
     subprocess.check_call([editor, fname])
     mtime_after = file_mtime(toml)
-    toml_after = open(fname).readlines()
+    with open(fname) as fobj:
+        toml_after = fobj.readlines()
     toml_relpath = "/".join(toml.split("/")[-2:])
     diff = list(difflib.unified_diff(toml_before, toml_after,
                                      fromfile=toml_relpath, tofile=toml_relpath,
                                      fromfiledate=mtime_before, tofiledate=mtime_after))
     return diff
 
+@functools.lru_cache()
+def cargo_version():
+    return subprocess.check_output(["cargo", "--version"], universal_newlines=True).strip()
+
+def load_cached_manifest(path):
+    # read-manifest output depends on cargo (target auto-discovery,
+    # feature normalization) and on what Metadata.from_json() expects
+    try:
+        with open(path) as fobj:
+            cached = json.load(fobj)
+    except (OSError, ValueError):
+        return None
+    if cached.get("format") != MANIFEST_CACHE_FORMAT or cached.get("cargo") != cargo_version():
+        return None
+    return cached["manifest"]
+
+def store_cached_manifest(path, manifest):
+    cached = {"format": MANIFEST_CACHE_FORMAT, "cargo": cargo_version(), "manifest": manifest}
+    # Like the bytecode cache, this is only a speed-up and must never fail a run
+    # (e.g. read-only $XDG_CACHE_HOME with the crate already downloaded)
+    path_part = f"{path}.part"
+    try:
+        with open(path_part, "w") as fobj:
+            json.dump(cached, fobj)
+        os.replace(path_part, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(path_part)
+
 def _is_path(path):
     return "/" in path or path in {".", ".."}
 
@@ -200,6 +263,7 @@ def make_diff_metadata(crate, version, patch=False, store=False):
         # Only things that look like a paths are considered local arguments
         if crate.endswith(".crate"):
             cratef, crate, version = local_crate(crate, version)
+            manifestf = None
         else:
             if store:
                 raise ValueError('--store-crate can only be used for a crate')
@@ -210,10 +274,20 @@ def make_diff_metadata(crate, version, patch=False, store=False):
             return metadata.name, diff, metadata
     else:
         cratef, crate, version = download(crate, version)
+        # Published crates are immutable, so their manifest can be reused
+        # as long as we do not patch it
+        manifestf = None if patch else os.path.join(CACHEDIR, f"{crate}-{version}.json")
 
-    with toml_from_crate(cratef, crate, version) as toml:
-        diff = make_patch(toml, enabled=patch)
-        metadata = Metadata.from_file(toml)
+    manifest = load_cached_manifest(manifestf) if manifestf is not None else None
+    if manifest is not None:
+        diff = []
+    else:
+        with toml_from_crate(cratef, crate, version) as toml:
+            diff = make_patch(toml, enabled=patch)
+            manifest = read_manifest(toml)
+        if manifestf is not None:
+            store_cached_manifest(manifestf, manifest)
+    metadata = Metadata.from_json(manifest)
     if store:
         shutil.copy2(cratef, os.path.join(os.getcwd(), f"{metadata.name}-{version}.crate"))
     return crate, diff, metadata
@@ -223,6 +297,9 @@ def to_list(s):
         return []
     return list(filter(None, (l.strip() for l in s.splitlines())))
 
+JINJA_ENV.globals["normalize_deps"] = normalize_deps
+JINJA_ENV.globals["to_list"] = to_list
+
 def main():
     parser = argparse.ArgumentParser("rust2rpm",
                                      formatter_class=argparse.RawTextHelpFormatter)
@@ -257,8 +334,11 @@ def main():
                                                patch=args.patch,
                                                store=args.store_crate)
 
-    JINJA_ENV.globals["normalize_deps"] = normalize_deps
-    JINJA_ENV.globals["to_list"] = to_list
+    try:
+        os.makedirs(JINJA_CACHEDIR, exist_ok=True)
+    except OSError:
+        # e.g. read-only $HOME in a chroot, just compile templates in memory
+        JINJA_ENV.bytecode_cache = None
     template = JINJA_ENV.get_template("main.spec")
 
     if args.patch and len(diff) > 0:
@@ -269,8 +349,13 @@ def main():
     kwargs = {}
     kwargs["crate"] = crate
     kwargs["target"] = args.target
-    bins = [tgt for tgt in metadata.targets if tgt.kind == "bin"]
-    libs = [tgt for tgt in metadata.targets if tgt.kind in ("lib", "rlib", "proc-macro")]
+    bins = []
+    libs = []
+    for tgt in metadata.targets:
+        if tgt.kind == "bin":
+            bins.append(tgt)
+        elif tgt.kind in ("lib", "rlib", "proc-macro"):
+            libs.append(tgt)
     is_bin = len(bins) > 0
     is_lib = len(libs) > 0
     if is_bin:
@@ -182,9 +182,7 @@ class Metadata:
 
     @classmethod
     def from_file(cls, path):
-        metadata = subprocess.check_output(["cargo", "read-manifest",
-                                            f"--manifest-path={path}"])
-        return cls.from_json(json.loads(metadata))
+        return cls.from_json(read_manifest(path))
 
     @property
     def all_dependencies(self):
@@ -219,3 +217,8 @@ class Metadata:
 
 def normalize_deps(deps):
     return set().union(*(d.normalize() for d in deps))
+
+def read_manifest(path):
+    metadata = subprocess.check_output(["cargo", "read-manifest",
+                                        f"--manifest-path={path}"])
+    return json.loads(metadata)
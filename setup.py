@@ -27,7 +27,6 @@ ARGS = dict(
 
         # CLI tool
         "jinja2",
-        "requests",
         "tqdm",
 
         # Rust cfg language parser
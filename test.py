@@ -1,6 +1,30 @@
+import io
+import os
+import tarfile
+
 import pytest
 
 import rust2rpm
+import rust2rpm.__main__
+
+CARGO_TOML = """\
+[package]
+name = "foo"
+version = "1.0.0"
+license = "MIT"
+
+[dependencies]
+bar = { version = "1.2", optional = true }
+"""
+
+def make_crate(path, files):
+    cratef = os.path.join(path, "foo-1.0.0.crate")
+    with tarfile.open(cratef, "w:gz") as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return cratef
 
 @pytest.mark.parametrize("req, rpmdep", [
     ("^1.2.3",
@@ -49,3 +73,72 @@ import rust2rpm
 def test_dependency(req, rpmdep):
     dep = rust2rpm.Dependency("test", req)
     assert str(dep) == rpmdep
+
+def test_cached_manifest(tmp_path, monkeypatch):
+    cratef = make_crate(str(tmp_path), {
+        "foo-1.0.0/Cargo.toml": CARGO_TOML.encode(),
+        "foo-1.0.0/src/lib.rs": b"",
+    })
+    cachedir = tmp_path / "cache"
+    cachedir.mkdir()
+    monkeypatch.setattr(rust2rpm.__main__, "CACHEDIR", str(cachedir))
+    monkeypatch.setattr(rust2rpm.__main__, "download",
+                        lambda crate, version: (cratef, crate, version))
+
+    _, _, metadata = rust2rpm.__main__.make_diff_metadata("foo", "1.0.0")
+    assert (cachedir / "foo-1.0.0.json").is_file()
+
+    def read_manifest(toml):
+        raise AssertionError("cached manifest was not used")
+    monkeypatch.setattr(rust2rpm.__main__, "read_manifest", read_manifest)
+    _, _, cached = rust2rpm.__main__.make_diff_metadata("foo", "1.0.0")
+
+    assert (cached.name, cached.version, cached.license) == \
+           (metadata.name, metadata.version, metadata.license)
+    assert {repr(t) for t in cached.targets} == {repr(t) for t in metadata.targets}
+    assert rust2rpm.metadata.normalize_deps(cached.all_dependencies) == \
+           rust2rpm.metadata.normalize_deps(metadata.all_dependencies)
+    assert sorted(cached.dependencies, key=str) == sorted(metadata.dependencies, key=str)
+
+def test_cached_manifest_unwritable(tmp_path, monkeypatch):
+    cratef = make_crate(str(tmp_path), {
+        "foo-1.0.0/Cargo.toml": CARGO_TOML.encode(),
+        "foo-1.0.0/src/lib.rs": b"",
+    })
+    # Missing cache directory, so the manifest cannot be stored
+    cachedir = tmp_path / "missing"
+    monkeypatch.setattr(rust2rpm.__main__, "CACHEDIR", str(cachedir))
+    monkeypatch.setattr(rust2rpm.__main__, "download",
+                        lambda crate, version: (cratef, crate, version))
+
+    _, _, metadata = rust2rpm.__main__.make_diff_metadata("foo", "1.0.0")
+    assert metadata.name == "foo"
+    assert not cachedir.exists()
+
+@pytest.fixture(params=[True, False], ids=["data_filter", "no_data_filter"])
+def data_filter(request, monkeypatch):
+    if request.param and not hasattr(tarfile, "data_filter"):
+        pytest.skip("tarfile has no extraction filters")
+    monkeypatch.setattr(rust2rpm.__main__, "HAS_TAR_FILTER", request.param)
+    return request.param
+
+def test_toml_from_crate(tmp_path, data_filter):
+    cratef = make_crate(str(tmp_path), {
+        "./foo-1.0.0/Cargo.toml": CARGO_TOML.encode(),
+        "./foo-1.0.0/src/lib.rs": b"",
+    })
+    with rust2rpm.__main__.toml_from_crate(cratef, "foo", "1.0.0") as toml:
+        with open(toml) as fobj:
+            assert fobj.read() == CARGO_TOML
+
+@pytest.mark.parametrize("name", ["../evil", "foo-1.0.0/../../evil", "{tmp_path}/evil"])
+def test_toml_from_crate_unsafe(tmp_path, data_filter, name):
+    name = name.format(tmp_path=tmp_path)
+    cratef = make_crate(str(tmp_path), {
+        "foo-1.0.0/Cargo.toml": CARGO_TOML.encode(),
+        name: b"",
+    })
+    with pytest.raises(Exception, match="Unsafe filenames!"):
+        with rust2rpm.__main__.toml_from_crate(cratef, "foo", "1.0.0"):
+            pass
+    assert not (tmp_path / "evil").exists()